@@ -1,15 +1,74 @@
 import streamlit as st
-import geopandas as gpd
-import folium
-from streamlit_folium import folium_static
-from folium.plugins import Draw
-from shapely.geometry import Point, LineString, Polygon, shape
+import base64
+import functools
+import io
 import json
+import hashlib
 import tempfile
+import time
+import weakref
 import os
 import zipfile
-import shutil
-import pandas as pd
+
+# The geo stack (geopandas/GDAL, shapely, folium, matplotlib) is imported where it is first used
+# so the page can render before those libraries finish loading.
+
+try:
+    # orjson parses large GeoJSON documents several times faster than the standard library
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+try:
+    # xxhash fingerprints large uploads an order of magnitude faster than md5; these keys aren't security sensitive
+    import xxhash
+    _digest = xxhash.xxh3_64_hexdigest
+except ImportError:
+    def _digest(data):
+        return hashlib.md5(data).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def _geopandas():
+    import geopandas as gpd
+    # Use pyogrio for all vector I/O; it reads and writes in bulk via GDAL instead of per feature
+    gpd.options.io_engine = "pyogrio"
+    return gpd
+
+@functools.lru_cache(maxsize=None)
+def _pyplot():
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+@functools.lru_cache(maxsize=None)
+def _use_arrow():
+    # pyogrio's Arrow read/write path needs pyarrow; without it fall back to its NumPy path
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+# Layers with more vertices than this are simplified before being drawn on the map
+SIMPLIFY_VERTEX_THRESHOLD = 100000
+# Approximate map width in pixels used to pick the simplification tolerance
+SIMPLIFY_TARGET_PIXELS = 4000
+# Line and polygon layers with more features than this are rendered to a PNG overlay instead of GeoJSON
+RASTERIZE_FEATURE_THRESHOLD = 20000
+# Width in pixels of the rendered overlay image
+RASTER_WIDTH_PIXELS = 2048
+# Point layers with more features than this are shown as marker clusters
+POINT_CLUSTER_THRESHOLD = 5000
+
+# Copies of uploads and their parsed GeoParquet versions are kept under this directory so repeat
+# uploads load quickly. It holds user data; set GEOPROCESSING_CACHE_DIR to move it somewhere private.
+CACHE_DIR = os.environ.get("GEOPROCESSING_CACHE_DIR", os.path.join(tempfile.gettempdir(), "geoprocessing"))
+# Cached files not used for this long are deleted
+CACHE_MAX_AGE_SECONDS = 24 * 60 * 60
+# Each cache subdirectory is trimmed to this size, least recently used files first
+CACHE_MAX_BYTES = 2 * 1024 ** 3
 
 def main():
     st.title("GeoSpatial File Viewer and Editor")
@@ -21,45 +80,58 @@ def main():
     commit your changes, and download the edited file.
     
     ### Features:
-    - Upload and view shapefiles or GeoJSON files
+    - Upload and view shapefiles, GeoJSON, GeoPackage or FlatGeobuf files
     - Display geometries on an interactive map
     - Draw new points, lines, or polygons directly on the map
     - Commit changes made to the data
-    - Download the edited file
-    - Convert between shapefile and GeoJSON formats
+    - Download the edited file as a shapefile or GeoJSON
     
     Get started by uploading a file using the file uploader below!
     """)
     
-    uploaded_file = st.file_uploader("Choose a shapefile (.zip) or GeoJSON file", type=["zip", "geojson"])
+    uploaded_file = st.file_uploader("Choose a shapefile (.zip), GeoJSON, GeoPackage or FlatGeobuf file", type=list(READERS))
     
     if 'gdf' not in st.session_state:
         st.session_state.gdf = None
     if 'new_features' not in st.session_state:
         st.session_state.new_features = []
+    if 'edits' not in st.session_state:
+        st.session_state.edits = None
 
     if uploaded_file is not None:
         try:
-            # Load and display the file
-            st.session_state.gdf = load_geodata(uploaded_file)
+            # Optionally read only part of the file for a quick preview of large datasets
+            max_features = st.number_input("Maximum features to load (0 loads all)", min_value=0, value=0, step=1000)
+            geometry_only = st.checkbox("Load geometries only (skip attribute columns)")
+            
+            # Load the file only when the upload or load options change so committed edits survive reruns
+            source_key = (uploaded_file.file_id, max_features, geometry_only)
+            if st.session_state.get('source_key') != source_key:
+                data = uploaded_file.getvalue()
+                st.session_state.gdf = load_geodata(data, uploaded_file.name, max_features=max_features or None, geometry_only=geometry_only)
+                st.session_state.edits = _empty_edits()
+                st.session_state.source_key = source_key
             if st.session_state.gdf is not None:
-                st.session_state.gdf, st.session_state.new_features = display_map_with_draw(st.session_state.gdf)
+                st.session_state.tree = build_spatial_index(st.session_state.gdf)
+                st.session_state.gdf, st.session_state.new_features = display_map_with_draw(st.session_state.gdf, st.session_state.edits)
                 
                 # Commit Changes button
                 if st.button("Commit Changes"):
                     if st.session_state.new_features:
-                        st.session_state.gdf = commit_changes(st.session_state.gdf, st.session_state.new_features)
-                        st.success("Changes committed successfully!")
+                        st.session_state.edits, added, skipped, errors = commit_changes(
+                            st.session_state.gdf, st.session_state.edits, st.session_state.new_features, st.session_state.tree
+                        )
                         st.session_state.new_features = []  # Clear new features after committing
+                        # Rerun so the map is rebuilt once from the updated data; the report is shown after the rerun
+                        st.session_state.commit_report = (added, skipped, errors, len(st.session_state.gdf) + len(st.session_state.edits))
+                        st.rerun()
                     else:
                         st.warning("No changes to commit. Draw some geometries on the map first.")
+                if 'commit_report' in st.session_state:
+                    show_commit_report(*st.session_state.pop('commit_report'))
 
-                # Download Edited File button
-                if st.session_state.gdf is not None:
-                    download_edited_file(st.session_state.gdf)
-                
-                # Convert and download
-                convert_and_download(st.session_state.gdf)
+                # Download the edited data in the chosen format
+                export_gdf(st.session_state.gdf, st.session_state.edits)
         except Exception as e:
             st.error(f"An error occurred while processing the file: {str(e)}")
             st.error("Please try uploading the file again or contact support if the issue persists.")
@@ -67,53 +139,249 @@ def main():
     st.markdown("---")
     st.markdown("Made by [mark.kirkpatrick@aecom.com](mailto:mark.kirkpatrick@aecom.com)")
 
-def load_geodata(file):
-    file_extension = file.name.split(".")[-1].lower()
-    
-    if file_extension == "zip":
-        # For zipped shapefiles
-        with tempfile.TemporaryDirectory() as tmpdir:
-            with zipfile.ZipFile(file, 'r') as zip_ref:
-                zip_ref.extractall(tmpdir)
-            # Find the .shp file in the extracted contents
-            shp_files = [f for f in os.listdir(tmpdir) if f.endswith('.shp')]
-            if not shp_files:
-                st.error("No .shp file found in the uploaded zip.")
-                return None
-            shp_path = os.path.join(tmpdir, shp_files[0])
-            gdf = gpd.read_file(shp_path)
-    elif file_extension == "geojson":
-        # For GeoJSON, we can read directly from the uploaded file
-        gdf = gpd.read_file(file)
-    else:
-        st.error("Unsupported file format. Please upload a zipped shapefile or GeoJSON file.")
+@st.cache_data(show_spinner="Loading geodata…", max_entries=4, hash_funcs={bytes: _digest})
+def load_geodata(file_bytes, name, max_features=None, geometry_only=False):
+    # Takes the raw bytes rather than the UploadedFile so Streamlit can hash the arguments directly
+    file_extension = name.split(".")[-1].lower()
+    read_kwargs = {"engine": "pyogrio", "use_arrow": _use_arrow(), "max_features": max_features}
+    if geometry_only:
+        read_kwargs["columns"] = []
+    
+    reader = READERS.get(file_extension)
+    if reader is None:
+        st.error("Unsupported file format. Please upload a zipped shapefile, GeoJSON, GeoPackage or FlatGeobuf file.")
         return None
     
+    # A GeoParquet copy of each parsed upload outlives the process, so repeat uploads skip GDAL entirely
+    parquet_path = _parquet_cache_path(file_bytes, file_extension, max_features, geometry_only)
+    if _use_arrow() and os.path.exists(parquet_path):
+        _touch(parquet_path)
+        return _geopandas().read_parquet(parquet_path)
+    
+    gdf = reader(file_bytes, read_kwargs)
+    if gdf is None:
+        return None
+    gdf = _reproject_4326(gdf)
+    
+    if _use_arrow():
+        # The cache is only an optimization; a frame GDAL read fine still loads if it can't be written
+        try:
+            _write_atomic(parquet_path, lambda tmp_path: gdf.to_parquet(tmp_path, compression="zstd"))
+        except Exception:
+            pass
+        _evict_cache(os.path.dirname(parquet_path))
+    return gdf
+
+def _parquet_cache_path(data, extension, max_features, geometry_only):
+    cache_dir = _cache_dir("parquet")
+    key = f"{_digest(data)}-{extension}-{max_features or 'all'}-{'geom' if geometry_only else 'full'}"
+    return os.path.join(cache_dir, f"{key}.parquet")
+
+def _cached_upload_path(data, extension):
+    # Write the upload to disk once per unique content so GDAL can open it by path
+    upload_dir = _cache_dir("uploads")
+    path = os.path.join(upload_dir, f"{_digest(data)}.{extension}")
+    if os.path.exists(path):
+        _touch(path)
+    else:
+        _write_atomic(path, lambda tmp_path: _write_bytes(tmp_path, data))
+        _evict_cache(upload_dir)
+    return path
+
+def _cache_dir(name):
+    path = os.path.join(CACHE_DIR, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _touch(path):
+    # Mark a cache hit so eviction treats the file as recently used
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+def _evict_cache(cache_dir):
+    # Drop files past CACHE_MAX_AGE_SECONDS, then the least recently used until under CACHE_MAX_BYTES
+    now = time.time()
+    entries = []
+    for entry in os.scandir(cache_dir):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if now - stat.st_mtime > CACHE_MAX_AGE_SECONDS:
+            _remove(entry.path)
+        elif not entry.name.endswith(".tmp"):
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        _remove(path)
+        total -= size
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def _write_bytes(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def _write_atomic(path, write):
+    # Write under a unique temporary name and rename into place, so other sessions never see a partial
+    # file and an interrupted write never leaves a truncated one behind
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def _read_zip_shapefile(data, read_kwargs):
+    # Check the archive listing in memory first so an upload without a shapefile is rejected before any disk write
+    with zipfile.ZipFile(io.BytesIO(data), 'r') as zip_ref:
+        shp_file = next((f for f in zip_ref.namelist() if _is_shapefile_member(f)), None)
+    if shp_file is None:
+        st.error("No .shp file found in the uploaded zip.")
+        return None
+    # Read straight out of the archive through GDAL's /vsizip/ filesystem
+    zip_path = _cached_upload_path(data, "zip")
+    return _geopandas().read_file(f"/vsizip/{zip_path}/{shp_file}", **read_kwargs)
+
+def _is_shapefile_member(name):
+    # Skip the __MACOSX/ resource-fork copies (._name.shp) that archives made on macOS carry
+    basename = name.rsplit("/", 1)[-1]
+    return (
+        name.lower().endswith('.shp')
+        and not name.startswith("__MACOSX/")
+        and not basename.startswith("._")
+    )
+
+def _read_geojson(data, read_kwargs):
+    # For GeoJSON, we can read directly from the uploaded bytes
+    return _geopandas().read_file(io.BytesIO(data), **read_kwargs)
+
+def _read_gpkg(data, read_kwargs):
+    # GeoPackage is SQLite-backed, so GDAL needs a real file on disk
+    return _geopandas().read_file(_cached_upload_path(data, "gpkg"), **read_kwargs)
+
+def _read_fgb(data, read_kwargs):
+    # Like GeoPackage, FlatGeobuf is opened by path from the cached upload
+    return _geopandas().read_file(_cached_upload_path(data, "fgb"), **read_kwargs)
+
+# Readers by file extension; each returns a GeoDataFrame, or None after reporting an error
+READERS = {
+    "zip": _read_zip_shapefile,
+    "geojson": _read_geojson,
+    "gpkg": _read_gpkg,
+    "fgb": _read_fgb,
+}
+
+def _reproject_4326(gdf):
     # Set CRS to EPSG:4326 (WGS84) if it's not already set
     if gdf.crs is None:
         gdf = gdf.set_crs("EPSG:4326")
-    else:
+    elif gdf.crs.to_epsg() != 4326 and not gdf.crs.equals("EPSG:4326"):
+        # Only reproject when the data isn't already WGS84
         gdf = gdf.to_crs("EPSG:4326")
     
     return gdf
 
-def display_map_with_draw(gdf):
-    st.subheader("Map View")
+# Fingerprints by id(gdf), held alongside a weak reference so entries drop out with their frame
+_fingerprints = {}
+
+def _gdf_fingerprint(gdf):
+    # Content key for GeoDataFrames passed to cached helpers. The caches are shared by every session, so it
+    # covers geometry, attribute values and CRS. Frames are never modified in place, so each one is hashed
+    # once per lifetime instead of once per cached call on every rerun.
+    import pandas as pd
+    import shapely
+    
+    key = id(gdf)
+    cached = _fingerprints.get(key)
+    if cached is not None and cached[0]() is gdf:
+        return cached[1]
+    geometry = gdf.geometry.values
+    # Null geometries have no WKB; the null mask keeps their positions part of the key
+    wkb = b"".join(w or b"" for w in shapely.to_wkb(geometry))
+    null_mask = shapely.is_missing(geometry).tobytes()
+    attributes = gdf.drop(columns=gdf.geometry.name)
+    # hash_pandas_object can't hash a frame without columns
+    attribute_hash = _digest(_hash_attributes(attributes).tobytes()) if len(attributes.columns) else None
+    crs = gdf.crs.to_wkt() if gdf.crs is not None else None
+    fingerprint = (len(gdf), tuple(gdf.columns), _digest(wkb), _digest(null_mask), attribute_hash, crs)
+    _fingerprints[key] = (weakref.ref(gdf, lambda _: _fingerprints.pop(key, None)), fingerprint)
+    return fingerprint
+
+def _hash_attributes(attributes):
+    import pandas as pd
     
     try:
-        # Project to a suitable CRS for centroid calculation
-        gdf_projected = gdf.to_crs(epsg=3857)  # Web Mercator projection
-        
-        # Calculate the center of the map
-        center_lat = gdf_projected.geometry.centroid.y.mean()
-        center_lon = gdf_projected.geometry.centroid.x.mean()
-        
-        # Create a map centered on the data
-        m = folium.Map(location=[center_lat, center_lon], zoom_start=10)
-        
-        # Add the GeoDataFrame to the map
+        return pd.util.hash_pandas_object(attributes, index=False).to_numpy()
+    except TypeError:
+        # List-valued properties (pyogrio returns GeoJSON arrays as ndarrays) aren't hashable; hash
+        # their full repr instead, which numpy's str() would truncate for long arrays
+        stable = attributes.astype(object).map(_stable_repr)
+        return pd.util.hash_pandas_object(stable, index=False).to_numpy()
+
+def _stable_repr(value):
+    if hasattr(value, "tolist"):
+        value = value.tolist()
+    if isinstance(value, (list, tuple, dict, set)):
+        return repr(value)
+    return value
+
+# Matched by qualified name so geopandas doesn't have to be imported to declare the cached helpers
+_GDF_HASH_FUNCS = {"geopandas.geodataframe.GeoDataFrame": _gdf_fingerprint}
+
+def _empty_edits():
+    return _geopandas().GeoDataFrame(geometry=[], crs="EPSG:4326")
+
+def _merge_edits(gdf, edits):
+    # Committed edits are kept apart from the base layer and only merged when a full frame is needed
+    if edits.empty:
+        return gdf
+    import pandas as pd
+    return _geopandas().GeoDataFrame(pd.concat([gdf, edits.to_crs(gdf.crs)], ignore_index=True), crs=gdf.crs)
+
+@st.cache_resource(hash_funcs=_GDF_HASH_FUNCS, max_entries=4)
+def _build_map(gdf, edits):
+    import folium
+    import numpy as np
+    from folium.plugins import Draw, FastMarkerCluster
+    
+    gdf = _merge_edits(gdf, edits)
+    
+    # Center the map on the midpoint of the data's bounding box
+    minx, miny, maxx, maxy = gdf.total_bounds
+    center_lat = (miny + maxy) / 2
+    center_lon = (minx + maxx) / 2
+    
+    # Create a map centered on the data
+    m = folium.Map(location=[center_lat, center_lon], zoom_start=10, prefer_canvas=True)
+    
+    # Add the GeoDataFrame to the map; very large layers are not embedded feature by feature
+    geom_types = gdf.geom_type
+    if len(gdf) > POINT_CLUSTER_THRESHOLD and geom_types.isin(["Point", "MultiPoint"]).all():
+        # Clustered client-side so only a handful of markers are drawn at low zoom; MultiPoints contribute each part
+        points = gdf.geometry.explode(index_parts=False)
+        points = points[~points.is_empty]
+        FastMarkerCluster(np.column_stack([points.y, points.x]).tolist()).add_to(m)
+    elif len(gdf) > RASTERIZE_FEATURE_THRESHOLD and not geom_types.isin(["Point", "MultiPoint"]).all():
+        folium.raster_layers.ImageOverlay(
+            # folium only embeds paths, URLs and arrays, so the PNG goes in as a data URL
+            image="data:image/png;base64," + base64.b64encode(_render_layer_png(gdf)).decode(),
+            bounds=[[miny, minx], [maxy, maxx]],
+        ).add_to(m)
+    else:
         folium.GeoJson(
-            gdf.__geo_interface__,
+            _gdf_to_display_geojson(gdf),
             style_function=lambda feature: {
                 'fillColor': 'blue',
                 'color': 'black',
@@ -121,32 +389,62 @@ def display_map_with_draw(gdf):
                 'fillOpacity': 0.7,
             }
         ).add_to(m)
-        
-        # Add draw control
-        draw = Draw(
-            draw_options={
-                'polyline': True,
-                'rectangle': True,
-                'polygon': True,
-                'circle': False,
-                'marker': True,
-                'circlemarker': False
-            },
-            edit_options={'edit': False}
-        )
-        draw.add_to(m)
+    
+    # Add draw control, offering only tools that match the layer so it can still be exported as a shapefile
+    family = _geometry_family(geom_types)
+    draw = Draw(
+        draw_options={
+            'polyline': family in (None, 'line'),
+            'rectangle': family in (None, 'polygon'),
+            'polygon': family in (None, 'polygon'),
+            'circle': False,
+            'marker': family in (None, 'point'),
+            'circlemarker': False
+        },
+        edit_options={'edit': False}
+    )
+    draw.add_to(m)
+
+    # Fit the map to the bounds of the data
+    m.fit_bounds([[miny, minx], [maxy, maxx]])
+    
+    # The family is returned too so callers can describe the draw tools without rescanning the data
+    return m, family
 
-        # Fit the map to the bounds of the data
-        m.fit_bounds(m.get_bounds())
+# Shapefiles hold a single one of these families per file
+_GEOMETRY_FAMILIES = {
+    "Point": "point",
+    "MultiPoint": "point",
+    "LineString": "line",
+    "MultiLineString": "line",
+    "LinearRing": "line",
+    "Polygon": "polygon",
+    "MultiPolygon": "polygon",
+}
+
+def _geometry_family(geom_types):
+    # The layer's single geometry family, or None when it is empty, mixed or holds collections
+    families = {_GEOMETRY_FAMILIES.get(t) for t in geom_types.dropna().unique()}
+    if len(families) == 1:
+        return families.pop()
+    return None
+
+def display_map_with_draw(gdf, edits):
+    from streamlit_folium import st_folium
+    
+    st.subheader("Map View")
+    new_features = []
+    
+    try:
+        m, family = _build_map(gdf, edits)
         
-        # Display the map
-        st.write("Displaying map...")
-        folium_static(m)
+        # Display the map; st_folium sends the drawn shapes back as GeoJSON features
+        # A fixed key keeps the same component instance across reruns instead of remounting it
+        output = st_folium(m, width=700, height=500, returned_objects=["all_drawings"], key="editor")
+        new_features = output.get("all_drawings") or []
         
-        # For now, we'll use a placeholder for new features
-        # In a production app, you'd need to implement a way to capture drawn features
-        new_features = []
-        st.info("Drawing features is currently not fully implemented. This is a placeholder for future functionality.")
+        if family is not None:
+            st.caption(f"Drawing is limited to {family} geometries so the edited layer can still be exported as a shapefile.")
         
     except Exception as e:
         st.error(f"An error occurred while displaying the map: {str(e)}")
@@ -154,43 +452,137 @@ def display_map_with_draw(gdf):
     
     return gdf, new_features
 
-def commit_changes(gdf, new_features):
-    if new_features:
-        st.write(f"Committing {len(new_features)} new features.")
-        for feature in new_features:
-            try:
-                geom = shape(feature['geometry'])
-                new_row = gpd.GeoDataFrame({'geometry': [geom]}, crs="EPSG:4326")
-                gdf = gpd.GeoDataFrame(pd.concat([gdf, new_row], ignore_index=True), crs=gdf.crs)
-                st.success(f"Added new {geom.geom_type}")
-            except Exception as e:
-                st.error(f"Error adding feature: {str(e)}")
-        st.write(f"GeoDataFrame now has {len(gdf)} features.")
+@st.cache_data(hash_funcs=_GDF_HASH_FUNCS, max_entries=4)
+def _gdf_to_display_geojson(gdf):
+    import shapely
+    
+    # Dense layers are simplified to roughly one pixel at the full extent; edits and downloads keep the originals.
+    # Vertices rather than features decide, so a single detailed coastline is simplified too.
+    if shapely.get_num_coordinates(gdf.geometry.values).sum() > SIMPLIFY_VERTEX_THRESHOLD:
+        minx, miny, maxx, maxy = gdf.total_bounds
+        tolerance = max(maxx - minx, maxy - miny) / SIMPLIFY_TARGET_PIXELS
+        gdf = gdf.assign(geometry=gdf.geometry.simplify(tolerance=tolerance, preserve_topology=True))
+    # The layer is styled with constants, so only geometry is serialized; this also keeps array-valued
+    # properties (which to_json can't encode) out of the map
+    return _json_loads(gdf[[gdf.geometry.name]].to_json())
+
+@st.cache_data(hash_funcs=_GDF_HASH_FUNCS, max_entries=4)
+def _render_layer_png(gdf):
+    plt = _pyplot()
+    # Render in Web Mercator so the image lines up with Leaflet when stretched over the layer bounds
+    gdf_projected = gdf.to_crs(epsg=3857)
+    minx, miny, maxx, maxy = gdf_projected.total_bounds
+    # The longer side gets RASTER_WIDTH_PIXELS and the other keeps the aspect ratio, so tall or
+    # near-degenerate extents can't produce an unbounded image
+    extent_x, extent_y = maxx - minx, maxy - miny
+    longest = max(extent_x, extent_y)
+    if longest > 0:
+        width = max(RASTER_WIDTH_PIXELS * extent_x / longest, 1)
+        height = max(RASTER_WIDTH_PIXELS * extent_y / longest, 1)
     else:
+        width = height = RASTER_WIDTH_PIXELS
+    fig = plt.figure(figsize=(width / 100, height / 100), dpi=100)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    gdf_projected.plot(ax=ax, facecolor="blue", edgecolor="black", linewidth=0.2, alpha=0.7)
+    ax.set_xlim(minx, maxx)
+    ax.set_ylim(miny, maxy)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", transparent=True)
+    plt.close(fig)
+    return buf.getvalue()
+
+@st.cache_resource(hash_funcs=_GDF_HASH_FUNCS, max_entries=4)
+def build_spatial_index(gdf):
+    import shapely
+    
+    # Built once per dataset so intersection queries against it are O(log N)
+    return shapely.STRtree(gdf.geometry.values)
+
+def commit_changes(gdf, edits, new_features, tree=None):
+    # Returns the updated edits with the added/skipped counts and parse errors; main reports them after its rerun
+    import pandas as pd
+    from shapely.geometry import shape
+    
+    geoms = []
+    skipped = 0
+    errors = []
+    for feature in new_features:
+        try:
+            geom = shape(feature['geometry'])
+            if (tree is not None and _is_duplicate(gdf, tree, geom)) or edits.geometry.geom_equals(geom).any():
+                skipped += 1
+                continue
+            geoms.append(geom)
+        except Exception as e:
+            errors.append(str(e))
+    if geoms:
+        # Append to the small edits frame so the base layer is never copied on commit
+        batch = _geopandas().GeoDataFrame({'geometry': geoms}, crs="EPSG:4326").to_crs(edits.crs)
+        edits = _geopandas().GeoDataFrame(pd.concat([edits, batch], ignore_index=True), crs=edits.crs)
+    return edits, len(geoms), skipped, errors
+
+def show_commit_report(added, skipped, errors, total):
+    # One element per kind of outcome rather than one per feature
+    if errors:
+        st.error(f"Error adding {len(errors)} feature(s): {'; '.join(errors)}")
+    if skipped:
+        st.warning(f"Skipped {skipped} geometries that already exist in the data")
+    if added:
+        st.success(f"Changes committed successfully! Added {added} new geometries; the data now has {total} features.")
+    elif not errors and not skipped:
         st.warning("No new features to commit.")
-    return gdf
 
-def download_edited_file(gdf):
-    st.subheader("Download Edited File")
-    file_format = st.selectbox("Select file format for download", ["GeoJSON", "Shapefile"])
+def _is_duplicate(gdf, tree, geom):
+    # Only candidates whose bounding boxes intersect reach the exact GEOS test
+    candidates = tree.query(geom, predicate="intersects")
+    return any(gdf.geometry.iloc[i].equals(geom) for i in candidates)
+
+@st.cache_data(hash_funcs=_GDF_HASH_FUNCS, max_entries=4)
+def _gdf_to_geojson_bytes(gdf, edits):
+    import pyogrio
+    
+    gdf = _merge_edits(gdf, edits)
+    buf = io.BytesIO()
+    pyogrio.write_dataframe(gdf, buf, driver="GeoJSON")
+    return buf.getvalue()
+
+@st.cache_data(hash_funcs=_GDF_HASH_FUNCS, max_entries=4)
+def _gdf_to_shp_zip_bytes(gdf, edits, basename):
+    import pyogrio
+    
+    gdf = _merge_edits(gdf, edits)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmp_shp = os.path.join(tmpdir, f"{basename}.shp")
+        pyogrio.write_dataframe(gdf, tmp_shp, driver="ESRI Shapefile", use_arrow=_use_arrow())
+        # Zip the components in memory; shapefiles barely compress, so store them uncompressed
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+            for name in os.listdir(tmpdir):
+                zf.write(os.path.join(tmpdir, name), arcname=name)
+    return buf.getvalue()
+
+def export_gdf(gdf, edits, key_suffix=""):
+    # Single download/convert path; key_suffix keeps widget keys unique if it is ever shown twice
+    st.subheader("Download or Convert")
+    file_format = st.selectbox("Select file format for download", ["GeoJSON", "Shapefile"], key=f"export_format{key_suffix}")
+    
+    # Serialize only once the user asks for the file, not on every rerun while the widgets are shown
+    if not st.checkbox("Prepare file", key=f"prepare_export{key_suffix}"):
+        return
     
     try:
         if file_format == "GeoJSON":
-            output = gdf.to_json()
+            output = _gdf_to_geojson_bytes(gdf, edits)
             filename = "edited_file.geojson"
             mime_type = "application/json"
         else:  # Shapefile
-            with tempfile.TemporaryDirectory() as tmpdir:
-                tmp_shp = os.path.join(tmpdir, "edited_file.shp")
-                gdf.to_file(tmp_shp, driver="ESRI Shapefile")
-                shp_zip = shutil.make_archive(os.path.join(tmpdir, "edited_file_shapefile"), 'zip', tmpdir)
-                with open(shp_zip, "rb") as f:
-                    output = f.read()
+            output = _gdf_to_shp_zip_bytes(gdf, edits, "edited_file")
             filename = "edited_file_shapefile.zip"
             mime_type = "application/zip"
         
         st.download_button(
-            label="Download Edited File",
+            label="Download File",
             data=output,
             file_name=filename,
             mime=mime_type
@@ -199,34 +591,5 @@ def download_edited_file(gdf):
         st.error(f"An error occurred while preparing the file for download: {str(e)}")
         st.error("Please try again or contact support if the issue persists.")
 
-def convert_and_download(gdf):
-    st.subheader("Convert and Download")
-    output_format = st.selectbox("Select output format for conversion", ["GeoJSON", "Shapefile"])
-    
-    try:
-        if output_format == "GeoJSON":
-            output = gdf.to_json()
-            filename = "converted.geojson"
-            mime_type = "application/json"
-        else:  # Shapefile
-            with tempfile.TemporaryDirectory() as tmpdir:
-                tmp_shp = os.path.join(tmpdir, "converted.shp")
-                gdf.to_file(tmp_shp, driver="ESRI Shapefile")
-                shp_zip = shutil.make_archive(os.path.join(tmpdir, "converted_shapefile"), 'zip', tmpdir)
-                with open(shp_zip, "rb") as f:
-                    output = f.read()
-            filename = "converted_shapefile.zip"
-            mime_type = "application/zip"
-        
-        st.download_button(
-            label="Download Converted File",
-            data=output,
-            file_name=filename,
-            mime=mime_type
-        )
-    except Exception as e:
-        st.error(f"An error occurred while converting the file: {str(e)}")
-        st.error("Please try again or contact support if the issue persists.")
-
 if __name__ == "__main__":
     main()